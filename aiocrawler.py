@@ -1,17 +1,22 @@
 import asyncio
+import codecs
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Set, List, Tuple, Optional, Union
-from urllib.parse import urljoin, urldefrag
+from urllib.parse import urljoin, urlsplit, SplitResult
 
 from aiohttp import ClientConnectionError, ClientPayloadError
-from aiohttp import ClientSession, ClientResponseError, ClientTimeout
+from aiohttp import ClientSession, ClientResponse, ClientResponseError, ClientTimeout, TCPConnector
 from aiohttp.client_exceptions import TooManyRedirects
+import charset_normalizer
 from multidict import CIMultiDictProxy
-from selectolax.parser import HTMLParser
+from selectolax.lexbor import LexborHTMLParser as HTMLParser
 from urllib3.util import create_urllib3_context
 import ssl
 import certifi
+import xxhash
 # from urllib3 import PoolManager
 
 logger = logging.getLogger('AsyncCrawler')
@@ -26,12 +31,49 @@ class InvalidContentTypeError(Exception):
         self.response = response
 
 
+class ContentTooLargeError(InvalidContentTypeError):
+    '''
+    Exception raised when a response body is larger than max_content_length
+    '''
+
+
 class AlreadyFetchedError(Exception):
-    def __init__(self):
-        pass
+    '''
+    Exception raised when a request is redirected to a url that has already been crawled
+    '''
+
+    def __init__(self, url: str, actual_url: str):
+        self.url = url
+        self.actual_url = actual_url
+
+
+def url_fingerprint(url: str) -> int:
+    '''
+    64-bit hash of a url. The crawler keeps these instead of the url strings themselves
+    to keep the visited set small on large crawls.
+    '''
+    return xxhash.xxh3_64_intdigest(url)
 
 
-@dataclass
+def join_url(base: SplitResult, url: str, href: str) -> str:
+    '''
+    Same result as urljoin(url, href), up to the fragment, for the common shapes of href, without
+    re-parsing the base url for every link on the page. Anything else (relative paths, dot segments,
+    empty queries, params, links without a host, control characters) is handed to urljoin.
+    '''
+    if href.isprintable() and ';' not in href and '?#' not in href and not href.endswith('?'):
+        if href.startswith(('http://', 'https://')):
+            if href.partition('//')[2][:1] not in ('', '/', '?', '#'):
+                return href
+        elif href.startswith('//'):
+            if href[2:3] not in ('', '/', '?', '#'):
+                return base.scheme + ':' + href
+        elif href.startswith('/') and '/.' not in href and '//' not in href:
+            return base.scheme + '://' + base.netloc + href
+    return urljoin(url, href)
+
+
+@dataclass(slots=True, frozen=True)
 class TaskQueueMessage:
     source_url: str
     url: str
@@ -47,6 +89,7 @@ class AsyncCrawler:
 
     timeout: int = 30
     max_redirects: int = 10
+    max_content_length: int = 10 * 1024 * 1024
     html_content_types: Set[str] = {
         'text/html',
         'text/xhtml',
@@ -62,6 +105,9 @@ class AsyncCrawler:
         'application/epub+zip',
     }
 
+    # hrefs that never lead to a crawlable page; skipped before any url parsing
+    skipped_href_prefixes: Tuple[str, ...] = ('#', 'mailto:', 'javascript:', 'tel:', 'data:')
+
     def __init__(
             self,
             starting_urls: list[str],
@@ -80,10 +126,47 @@ class AsyncCrawler:
         self.concurrency = concurrency
         self.max_retries = max_retries
         self.headers = headers
-        self.crawled_urls: Set[str] = set()
+        self.crawled_urls: Set[int] = set()  # url_fingerprint() of every url admitted so far
         self.results: List = []
         self.session: Optional[ClientSession] = None
+        self._session_lock = asyncio.Lock()
         self.task_queue: Optional[asyncio.Queue] = None
+        self.parse_executor: Optional[ThreadPoolExecutor] = None
+
+    def _create_session(self) -> ClientSession:
+        """
+        Builds the ClientSession shared by all workers. The connector keeps connections alive
+        between requests so that repeated fetches against the same host skip the TCP/TLS handshake.
+        """
+        ctx = create_urllib3_context(ciphers=":HIGH:!DH:!aNULL", ssl_minimum_version=ssl.TLSVersion.MINIMUM_SUPPORTED)
+        ctx.load_verify_locations(cafile=certifi.where())
+
+        connector = TCPConnector(
+            limit=self.concurrency * 2,
+            limit_per_host=16,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+            use_dns_cache=True,
+            enable_cleanup_closed=True,
+            ssl=ctx,
+        )
+        return ClientSession(
+            connector=connector,
+            timeout=ClientTimeout(total=self.timeout),
+            headers=self.headers,
+            raise_for_status=True,
+        )
+
+    async def _get_session(self) -> ClientSession:
+        """
+        Returns the shared session, creating it on first use.
+        The lock keeps the first wave of workers from racing to create their own sessions.
+        """
+        if self.session is None:
+            async with self._session_lock:
+                if self.session is None:
+                    self.session = self._create_session()
+        return self.session
 
     async def _make_request(self, url: str) -> Tuple[
         str, str, Union[str, bytes], CIMultiDictProxy[str, str]]:
@@ -92,74 +175,97 @@ class AsyncCrawler:
         :param url: the url to fetch
         :return: tuple of actual url (if redirected) and html
         """
-        if not self.session:
-            self.session = ClientSession()
+        session = await self._get_session()
 
         logging.debug(f'Fetching: {url}')
-        timeout = ClientTimeout(total=self.timeout)
 
-        ctx = create_urllib3_context(ciphers=":HIGH:!DH:!aNULL", ssl_minimum_version=ssl.TLSVersion.MINIMUM_SUPPORTED)
-        ctx.load_verify_locations(cafile=certifi.where())
-
-        async with self.session.get(
-                url,
-                headers=self.headers,
-                raise_for_status=True,
-                timeout=timeout,
-                max_redirects=self.max_redirects,
-                # verify_ssl=False,
-                ssl_context=ctx
-        ) as response:
+        async with session.get(url, max_redirects=self.max_redirects) as response:
 
             actual_url = response.url.human_repr()
             if actual_url != url:
                 # We were redirected to a new URL
                 # check that we haven't already fetched the new URL. If so, let's ignore
-                if response.url in self.crawled_urls:
-                    raise AlreadyFetchedError()
-
-            if response.content_type in self.html_content_types:
-                html = await response.text()
-                return "text/html", actual_url, html, response.headers
-            elif response.content_type in self.binary_content_types:
-                content = await response.read()
-                return response.content_type, actual_url, content, response.headers
-            else:
+                if url_fingerprint(actual_url) in self.crawled_urls:
+                    raise AlreadyFetchedError(url, actual_url)
+
+            is_html = response.content_type in self.html_content_types
+            if not is_html and response.content_type not in self.binary_content_types:
                 raise InvalidContentTypeError(response)
+            if (response.content_length or 0) > self.max_content_length:
+                raise ContentTooLargeError(response)
+
+            content = await self._read_body(response)
+            if is_html:
+                return "text/html", actual_url, self._decode_body(response, content), response.headers
+            else:
+                return response.content_type, actual_url, content, response.headers
 
-    def extract_links(self, url: str, html: str) -> Set[str]:
+    async def _read_body(self, response: ClientResponse) -> bytes:
+        """
+        Reads the response body, giving up as soon as it grows past max_content_length.
+        Content-Length is checked up front, but it may be missing or describe the compressed body.
+        """
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            size += len(chunk)
+            if size > self.max_content_length:
+                raise ContentTooLargeError(response)
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    @staticmethod
+    def _decode_body(response: ClientResponse, body: bytes) -> str:
+        """
+        Decodes with the charset from the Content-Type header if there is a usable one,
+        otherwise as utf-8, only sniffing the encoding when the body isn't valid utf-8.
+        """
+        encoding = response.charset
+        if encoding:
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                encoding = None
+        if not encoding:
+            try:
+                return body.decode("utf-8")
+            except UnicodeDecodeError:
+                encoding = charset_normalizer.detect(body)["encoding"] or "utf-8"
+        return body.decode(encoding, errors="replace")
+
+    def extract_links(self, url: str, html: str) -> List[str]:
         '''
-        Finds all the links in passed html
+        Finds all the links in passed html, deduplicated and in document order
         '''
-        links = set()
+        links = {}
+        base = urlsplit(url)
         dom = HTMLParser(html)
-        for tag in dom.css('a'):
-            attrs = tag.attributes
-            if 'href' in attrs:
-                href = attrs['href']
-                if not href or href.startswith('mailto:'):
-                    continue
-                href = urldefrag(urljoin(url, href))[0]
-                links.add(href)
-        links = {x for x in links if self.valid_link(url, x)}
-        return links
+        for tag in dom.tags('a'):
+            href = tag.attrs.get('href')
+            if not href or href.startswith(self.skipped_href_prefixes):
+                continue
+            href = join_url(base, url, href).partition('#')[0]
+            links[href] = None
+        return [x for x in links if self.valid_link(url, x)]
 
     def valid_link(self, url: str, link: str):
         return True
 
-    def output(self, content_type: str, url: str, links: Set[str], content: Union[str, bytes],
+    def output(self, content_type: str, url: str, links: List[str], content: Union[str, bytes],
                response_headers: CIMultiDictProxy[str]) -> Optional[Tuple[str, str]]:
         raise NotImplementedError(
             '{}.output callback is not defined'.format(self.__class__.__name__)
         )
 
-    async def crawl_page(self, url: str) -> Tuple[str, str, Set[str], Union[str, bytes], CIMultiDictProxy[str, str]]:
+    async def crawl_page(self, url: str) -> Tuple[str, str, List[str], Union[str, bytes], CIMultiDictProxy[str, str]]:
         '''
         Request a webpage and return all relevant data from it
         '''
         content_type, actual_url, content, response_headers = await self._make_request(url)
         if content_type == "text/html":
-            links = self.extract_links(actual_url, content)
+            # parsing is CPU work; run it off the event loop so other workers keep fetching meanwhile
+            loop = asyncio.get_running_loop()
+            links = await loop.run_in_executor(self.parse_executor, self.extract_links, actual_url, content)
         else:
             links = None
         return content_type, actual_url, links, content, response_headers
@@ -169,76 +275,96 @@ class AsyncCrawler:
         Retries a task if max retries not hit
         '''
         if task.retry_count < self.max_retries:
-            self.crawled_urls.discard(task.url)
+            self.crawled_urls.discard(url_fingerprint(task.url))
             task_message = TaskQueueMessage(task.source_url, task.url, task.depth, task.retry_count + 1)
-            await self.task_queue.put(task_message)
+            self.schedule(task_message)
         else:
             logger.error(f'Max retries exceeded for url: {task.url}')
 
-    async def worker(self) -> None:
+    def schedule(self, task: TaskQueueMessage) -> None:
         '''
-        Pops a url from the task queue and crawls the page
+        Queues the task for the workers, unless it is too deep or its url was already admitted.
+        Urls are admitted when queued, so a link found on many pages is only ever queued once.
         '''
-        while True:
-
-            if not self.task_queue:
-                break
-
-            task = await self.task_queue.get()
-            logger.debug(f'Working on {task.url} at {task.depth}')
+        if task.depth >= self.max_depth:
+            logger.debug('Max depth reached')
+            return
 
-            if (task.depth >= self.max_depth) or (task.url in self.crawled_urls):
-                self.task_queue.task_done()
-                logger.debug('Max depth reached')
-                continue
+        fingerprint = url_fingerprint(task.url)
+        if fingerprint in self.crawled_urls:
+            return
 
-            if (self.max_pages > 0) and (len(self.crawled_urls) > self.max_pages):
-                self.task_queue.task_done()
-                logger.debug('Max pages reached')
-                continue
+        if (self.max_pages > 0) and (len(self.crawled_urls) > self.max_pages):
+            logger.debug('Max pages reached')
+            return
 
-            self.crawled_urls.add(task.url)
+        self.crawled_urls.add(fingerprint)
+        self.task_queue.put_nowait(task)
 
+    async def worker(self) -> None:
+        '''
+        Pops tasks from the task queue and crawls their pages, until cancelled
+        '''
+        while True:
+            task = await self.task_queue.get()
             try:
-                content_type, url, links, content, response_headers = await self.crawl_page(task.url)
-            except InvalidContentTypeError as excp:
-                pass
-            except AlreadyFetchedError as excp:
-                pass
-            except TooManyRedirects as excp:
-                self.log_error_url(task.url, "too_many_redirects", f'Redirected too many times at url: {task.url}')
-            except ClientPayloadError as excp:
-                self.log_error_url(task.url, "invalid_encoding", f'Invalid compression or encoding at url: {task.url}')
-            except asyncio.TimeoutError as excp:
-                self.log_error_url(task.url, "timeout", f'Timeout: {task.url}')
-                # await self.retry_task(task)
-            except ClientResponseError as excp:
-                if excp.status > 499:
-                    self.log_error_url(task.url, excp.status, f'Server error at url: {task.url}')
-                else:
-                    self.log_error_url(task.url, excp.status,
-                                       f'Client error with status: {excp.status} at url: {task.url} from {task.source_url}')
-            except ClientConnectionError as excp:
-                print(excp)
-                self.log_error_url(task.url, "connection_error", f'Connection error at url: {task.url}, skipping ....')
-                # await self.retry_task(task)
-            except Exception as excp:
-                self.log_error_url(task.url, "exception", f'Unhandled exception: {type(excp)} {excp}')
-            else:
-                result = self.output(content_type, url, links, content, response_headers)
-                if result:
-                    self.results.append(result)
-
-                if links:
-                    for link in links.difference(self.crawled_urls):
-                        task_message = TaskQueueMessage(url, link, task.depth + 1, 0)
-                        await self.task_queue.put(task_message)
+                await self.process_task(task)
             finally:
                 self.task_queue.task_done()
 
+    async def process_task(self, task: TaskQueueMessage) -> None:
+        '''
+        Crawls the page for a single task and schedules its outgoing links
+        '''
+        logger.debug(f'Working on {task.url} at {task.depth}')
+
+        try:
+            content_type, url, links, content, response_headers = await self.crawl_page(task.url)
+        except ContentTooLargeError as excp:
+            self.log_skipped_url(task.url, "too_large",
+                                 f'Body larger than {self.max_content_length} bytes at url: {task.url}')
+        except InvalidContentTypeError as excp:
+            pass
+        except AlreadyFetchedError as excp:
+            pass
+        except TooManyRedirects as excp:
+            self.log_error_url(task.url, "too_many_redirects", f'Redirected too many times at url: {task.url}')
+        except ClientPayloadError as excp:
+            self.log_error_url(task.url, "invalid_encoding", f'Invalid compression or encoding at url: {task.url}')
+        except asyncio.TimeoutError as excp:
+            self.log_error_url(task.url, "timeout", f'Timeout: {task.url}')
+            # await self.retry_task(task)
+        except ClientResponseError as excp:
+            if excp.status > 499:
+                self.log_error_url(task.url, excp.status, f'Server error at url: {task.url}')
+            else:
+                self.log_error_url(task.url, excp.status,
+                                   f'Client error with status: {excp.status} at url: {task.url} from {task.source_url}')
+        except ClientConnectionError as excp:
+            print(excp)
+            self.log_error_url(task.url, "connection_error", f'Connection error at url: {task.url}, skipping ....')
+            # await self.retry_task(task)
+        except Exception as excp:
+            self.log_error_url(task.url, "exception", f'Unhandled exception: {type(excp)} {excp}')
+        else:
+            result = self.output(content_type, url, links, content, response_headers)
+            if result:
+                self.results.append(result)
+
+            depth = task.depth + 1
+            if links and depth < self.max_depth:
+                for link in links:
+                    self.schedule(TaskQueueMessage(url, link, depth, 0))
+
     def log_error_url(self, url, error_code: int, error_message: str):
         logger.error(url, error_code, error_message)
 
+    def log_skipped_url(self, url, reason: str, message: str):
+        """
+        Called for a page that was reachable but deliberately not crawled, e.g. as its body is too large.
+        """
+        logger.warning(message)
+
     def crawl_completed(self):
         pass
 
@@ -247,20 +373,26 @@ class AsyncCrawler:
         Starts concurrent workers and kickstarts scraping
         '''
         self.task_queue = asyncio.Queue()
+        self.parse_executor = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
         for url in self.starting_urls:
             task_message = TaskQueueMessage(url, url, 0, 0)
-            self.task_queue.put_nowait(task_message)
+            self.schedule(task_message)
         workers = [asyncio.create_task(self.worker()) for i in range(self.concurrency)]
 
-        await self.task_queue.join()
+        try:
+            await self.task_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
 
-        for worker in workers:
-            worker.cancel()
+            self.parse_executor.shutdown(wait=False, cancel_futures=True)
+            self.parse_executor = None
 
-        self.crawl_completed()
+            if self.session:
+                await self.session.close()
+                self.session = None
 
-        if self.session:
-            await self.session.close()
+        self.crawl_completed()
 
     async def get_results(self) -> List:
         '''
@@ -1,15 +1,31 @@
-import json
-from typing import Optional, Any
+import copy
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional, Any, Dict, Iterable, Mapping, Tuple
 
 import lmdb
+import orjson
 from lmdbm import Lmdb
 
 _binary_suffix = "^bytes"
+_unparsed_hash_key = b"\x00parsed_hash"
+
+
+def _approx_size(value) -> int:
+    """
+    Rough size of a buffered value: the bytes of a binary, the characters of a document's content.
+    """
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return len(value.get("_content") or "")
+    return 0
 
 
 class JsonLmdb(Lmdb):
     """
-    Serializes and deserializes values to/from lmdb using JSON.
+    Serializes and deserializes values to/from lmdb using JSON (via orjson).
     If the key has a binary suffix (hardcoded as ^bytes), then the JSON ser/deserialization is skipped.
     """
     def _pre_key(self, value):
@@ -19,10 +35,10 @@ class JsonLmdb(Lmdb):
         return value.decode("utf-8")
 
     def _pre_value(self, value):
-        return json.dumps(value).encode("utf-8")
+        return orjson.dumps(value)
 
     def _post_value(self, value):
-        return json.loads(value.decode("utf-8"))
+        return orjson.loads(value)
 
     def __getitem__(self, key):
         """
@@ -78,97 +94,347 @@ class JsonLmdb(Lmdb):
                     value = self._post_value(value)
                 yield (key, value)
 
+    def get(self, key, default=None):
+        """
+        Single read transaction lookup, returning default instead of raising KeyError.
+        """
+        with self.env.begin() as txn:
+            value = txn.get(self._pre_key(key))
+        if value is None:
+            return default
+        if not key.endswith(_binary_suffix):
+            value = self._post_value(value)
+        return value
+
+    def put_many(self, items: Iterable[Tuple[str, Any]]) -> None:
+        """
+        Writes all the (key, value) pairs in a single write transaction.
+        MapFullError is handled the same way as in __setitem__.
+        """
+        pairs = [(self._pre_key(key), value if key.endswith(_binary_suffix) else self._pre_value(value))
+                 for key, value in items]
+        for i in range(12):
+            try:
+                with self.env.begin(write=True) as txn:
+                    with txn.cursor() as curs:
+                        curs.putmulti(pairs)
+                    return
+            except lmdb.MapFullError:
+                if not self.autogrow:
+                    raise
+                new_map_size = self.map_size * 2
+                self.map_size = new_map_size
+
+        exit(self.autogrow_error.format(self.env.path()))
+
+    def update_value(self, key: str, properties: dict) -> None:
+        """
+        Merges properties into the JSON document at key, reading and writing it within the same
+        write transaction. Raises KeyError if there is no such document.
+        """
+        k = self._pre_key(key)
+        for i in range(12):
+            try:
+                with self.env.begin(write=True) as txn:
+                    value = txn.get(k)
+                    if value is None:
+                        raise KeyError(key)
+                    value = self._post_value(value)
+                    value.update(properties)
+                    txn.put(k, self._pre_value(value))
+                    return
+            except lmdb.MapFullError:
+                if not self.autogrow:
+                    raise
+                new_map_size = self.map_size * 2
+                self.map_size = new_map_size
+
+        exit(self.autogrow_error.format(self.env.path()))
+
 
 class LmdbmDocumentCollection:
 
-    def __init__(self, file: str, mode: str = "c") -> None:
+    def __init__(self, file: str, mode: str = "c", map_size: int = 2 ** 30) -> None:
         super().__init__()
         self.file = file
-        self.db = JsonLmdb.open(file, mode, map_size=2 ** 30)
+        self.mode = mode
+        self.db = JsonLmdb.open(file, mode, map_size=map_size)
+        self._batch: Optional[dict] = None
+        self._batch_size = 0
+        self._batch_max_bytes = 0
+        self._batch_bytes = 0
+        self._batch_interval = 0.0
+        self._last_flush = 0.0
+        self._unparsed: Optional[lmdb.Environment] = None
+        self._batch_unparsed: set = set()
+
+    @contextmanager
+    def batch(self, size: int = 1000, max_bytes: int = 64 * 1024 * 1024, interval: float = 5.0):
+        """
+        Buffers writes made inside the block and commits them `size` at a time, so that a
+        thousand documents cost one LMDB transaction rather than a thousand.
+        The buffer is also committed once it holds about max_bytes of content, as binaries can be
+        megabytes each, and on the first write `interval` seconds after the last commit, so that
+        readers in other processes (and a killed crawl) are never far behind.
+        Buffered documents are visible to lookups by key, and are flushed before any iteration.
+        """
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = {}
+        self._batch_size = size
+        self._batch_max_bytes = max_bytes
+        self._batch_interval = interval
+        self._batch_bytes = 0
+        self._last_flush = time.monotonic()
+        try:
+            yield self
+        finally:
+            try:
+                self.flush()
+            finally:
+                self._batch = None
+
+    def flush(self) -> None:
+        if self._batch_unparsed:
+            # indexed before the documents are written, so that a crash in between cannot lose one
+            self._put_unparsed(self._batch_unparsed)
+            self._batch_unparsed.clear()
+        if self._batch:
+            self.db.put_many(self._batch.items())
+            self._batch.clear()
+        self._batch_bytes = 0
+        self._last_flush = time.monotonic()
+
+    def _put(self, key: str, value) -> None:
+        if self._batch is None:
+            self.db[key] = value
+        else:
+            self._batch[key] = value
+            self._batch_bytes += _approx_size(value)
+            if len(self._batch) >= self._batch_size or self._batch_bytes >= self._batch_max_bytes or \
+                    time.monotonic() - self._last_flush >= self._batch_interval:
+                self.flush()
 
     def add(self, key: str, content: Optional[str], **kwargs) -> None:
         if content is not None:
             kwargs["_content"] = content
-        self.db[key] = kwargs
+        self._put(key, kwargs)
 
     def add_html(self, key: str, content: str, **kwargs) -> None:
         kwargs["_content"] = content
         kwargs["content_type"] = "text/html"
-        self.db[key] = kwargs
+        self._put(key, kwargs)
 
     def add_binary(self, key: str, content: bytes, content_type: str, **kwargs) -> None:
         # binary files get their bytes saved to _bytes and in the extraction phase, the _content field gets populated
         kwargs["_content"] = "N/A"
         kwargs["content_type"] = content_type
-        self.db[key] = kwargs
-        self.db[key + _binary_suffix] = content
+        self._put(key, kwargs)
+        self._put(key + _binary_suffix, content)
 
     def add_text(self, key: str, content: str, **kwargs) -> None:
         kwargs["_content"] = content
         kwargs["content_type"] = "text/plain"
-        self.db[key] = kwargs
+        self._put(key, kwargs)
 
     def get_content(self, key: str):
-        return self.db[key]["_content"]
+        return self[key]["_content"]
 
     def get_binary(self, key: str):
-        return self.db[key + _binary_suffix]
+        return self[key + _binary_suffix]
 
     def set_property(self, key: str, property_name: str, property_value: Any) -> None:
-        val = self.db[key]
-        val[property_name] = property_value
-        self.db[key] = val
+        self.update_properties(key, **{property_name: property_value})
+
+    def update_properties(self, key: str, **properties) -> None:
+        if self._batch is not None:
+            val = self[key]
+            val.update(properties)
+            self._put(key, val)
+        else:
+            self.db.update_value(key, properties)
 
     def __getitem__(self, key):
+        if self._batch and key in self._batch:
+            # hand out a copy, as a fresh decode from LMDB would be
+            return copy.copy(self._batch[key])
         return self.db.__getitem__(key)
 
+    def get(self, key, default=None):
+        if self._batch and key in self._batch:
+            return copy.copy(self._batch[key])
+        return self.db.get(key, default)
+
     def __setitem__(self, key, value):
-        self.db.__setitem__(key, value)
+        self._put(key, value)
 
     def __delitem__(self, key):
+        if self._batch:
+            self._batch.pop(key, None)
         self.db.__delitem__(key)
 
     def __contains__(self, key):
+        if self._batch and key in self._batch:
+            return True
         return self.db.__contains__(key)
 
     def clear(self):
+        if self._batch:
+            self._batch.clear()
+        self._batch_unparsed.clear()
         self.db.clear()
+        if self._unparsed_env() is not None:
+            with self._unparsed.begin(write=True) as txn:
+                txn.drop(self._unparsed.open_db(), delete=False)
 
     def keys(self):
+        self.flush()
         return self.db.keys()
 
     def items(self):
+        self.flush()
         return self.db.items()
 
+    def last_txnid(self) -> int:
+        """
+        Id of the last committed write transaction, by any process. It changes whenever the collection does.
+        """
+        return self.db.env.info()["last_txnid"]
+
+    def adopt_map_size(self) -> None:
+        """
+        Adopts the map size of the data file, after a writer in another process has grown it beyond this
+        environment's. Long-lived readers need this, as LMDB fails their next transaction with
+        lmdb.MapResizedError until they do. No transaction may be open.
+        """
+        self.db.env.set_mapsize(0)
+
+    def prefetch(self) -> None:
+        """
+        Hints the kernel that the whole collection is about to be read front to back, so that it
+        reads the data file ahead instead of faulting the mmap in one page at a time.
+        A no-op where posix_fadvise is unavailable.
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        fd = os.open(os.path.join(self.db.env.path(), "data.mdb"), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
     def is_binary_key(self, key):
         return key.endswith("^bytes")
 
     def filter_keys(self, key, value):
-        for k, v in self.db.items():
+        for k, v in self.items():
             if self.is_binary_key(k):
                 continue
             if v[key] == value:
                 yield k
 
     def filter_values(self, key, value):
-        for k, v in self.db.items():
+        for k, v in self.items():
             if self.is_binary_key(k):
                 continue
             if v[key] == value:
                 yield v
 
     def filter_items(self, key, value):
-        for k, v in self.db.items():
+        for k, v in self.items():
             if self.is_binary_key(k):
                 continue
             if v[key] == value:
                 yield k, v
 
     def __iter__(self):
+        self.flush()
         return self.db.__iter__()
 
     def __len__(self):
+        self.flush()
         return self.db.__len__()
 
+    def _unparsed_env(self) -> Optional[lmdb.Environment]:
+        """
+        The index of documents still to be parsed: a keys-only LMDB environment inside the collection's
+        directory, kept apart so that it never shows up when iterating the documents.
+        None if the collection is read-only and has no index.
+        """
+        if self._unparsed is None:
+            try:
+                self._unparsed = lmdb.open(os.path.join(self.file, "unparsed"), map_size=2 ** 30,
+                                           readonly=self.mode == "r", create=self.mode != "r")
+            except lmdb.Error:
+                return None
+        return self._unparsed
+
+    def _put_unparsed(self, keys: Iterable[str]) -> None:
+        # a fresh mark per write, so that a pass can tell whether a key was marked again after it read the index
+        mark = os.urandom(8)
+        with self._unparsed_env().begin(write=True) as txn:
+            for key in keys:
+                txn.put(key.encode("utf-8"), mark)
+
+    def mark_unparsed(self, key: str) -> None:
+        """
+        Records that the document at key needs to be (re)parsed, see unparsed_keys.
+        """
+        if self._batch is None:
+            self._put_unparsed((key,))
+        else:
+            self._batch_unparsed.add(key)
+
+    def unparsed_keys(self, parsed_hash: Any) -> Optional[Dict[str, bytes]]:
+        """
+        Keys marked unparsed since the last full pass with parsed_hash, mapped to their marks (see mark_parsed),
+        or None if there has been no such pass (e.g. the rules changed), in which case every document has
+        to be looked at.
+        """
+        self.flush()
+        env = self._unparsed_env()
+        if env is None:
+            return None
+        with env.begin() as txn:
+            if txn.get(_unparsed_hash_key) != str(parsed_hash).encode("utf-8"):
+                return None
+            return self._read_marks(txn)
+
+    def unparsed_marks(self) -> Dict[str, bytes]:
+        """
+        Every key in the unparsed index, mapped to its mark, whatever pass it is from. Read before a full pass,
+        to be handed to mark_parsed after it.
+        """
+        self.flush()
+        env = self._unparsed_env()
+        if env is None:
+            return {}
+        with env.begin() as txn:
+            return self._read_marks(txn)
+
+    @staticmethod
+    def _read_marks(txn: lmdb.Transaction) -> Dict[str, bytes]:
+        return {k.decode("utf-8"): v for k, v in txn.cursor().iternext() if k != _unparsed_hash_key}
+
+    def mark_parsed(self, marks: Mapping[str, bytes], full_pass_hash: Any = None) -> None:
+        """
+        Removes the keys a pass has settled from the unparsed index. marks are as read before the pass, by
+        unparsed_keys or unparsed_marks: a key marked again since then keeps its new mark, to be parsed
+        by the next pass. full_pass_hash is given after a pass over the whole collection, and makes
+        unparsed_keys(full_pass_hash) usable from then on.
+        """
+        with self._unparsed_env().begin(write=True) as txn:
+            for key, mark in marks.items():
+                k = key.encode("utf-8")
+                if txn.get(k) == mark:
+                    txn.delete(k)
+            if full_pass_hash is not None:
+                txn.put(_unparsed_hash_key, str(full_pass_hash).encode("utf-8"))
+
     def close(self):
+        self.flush()
         self.db.close()
+        if self._unparsed is not None:
+            self._unparsed.close()
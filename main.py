@@ -1,5 +1,7 @@
 import threading
+from collections import OrderedDict
 
+import lmdb
 from celery.result import AsyncResult
 from fastapi import FastAPI, Body, Query
 
@@ -10,6 +12,47 @@ from tasks import start_crawl
 app = FastAPI()
 running_jobs = set()
 
+MAX_OPEN_COLLECTIONS = 32
+open_collections: "OrderedDict[str, LmdbmDocumentCollection]" = OrderedDict()
+content_keys_cache: dict[str, tuple[int, list[str]]] = {}
+
+
+def get_collection(name: str) -> LmdbmDocumentCollection:
+    """
+    Returns the collection for a crawl, keeping the most recently used LMDB environments open
+    between requests rather than opening (and mmapping) one per request.
+    """
+    collection = open_collections.get(name)
+    if collection is None:
+        collection = open_collections[name] = LmdbmDocumentCollection(f"data/{name}.crawl")
+        if len(open_collections) > MAX_OPEN_COLLECTIONS:
+            evicted_name, evicted = open_collections.popitem(last=False)
+            content_keys_cache.pop(evicted_name, None)
+            evicted.close()
+    else:
+        open_collections.move_to_end(name)
+    return collection
+
+
+def get_content_keys(name: str, collection: LmdbmDocumentCollection) -> list[str]:
+    """
+    Lists the keys of the content documents in a collection. The list is reused until the collection
+    is written to again, so paging through a crawl doesn't rescan the whole collection for every page.
+    """
+    txnid = collection.last_txnid()
+    cached = content_keys_cache.get(name)
+    if cached is None or cached[0] != txnid:
+        cached = content_keys_cache[name] = (txnid, list(collection.filter_keys("type", "content")))
+    return cached[1]
+
+
+@app.on_event("shutdown")
+def close_collections():
+    content_keys_cache.clear()
+    while open_collections:
+        _, collection = open_collections.popitem()
+        collection.close()
+
 
 @app.get("/health")
 @app.get("/health/")
@@ -56,9 +99,17 @@ async def browse_results(
     page: int = Query(default=0, ge=0), 
     rows: int = Query(default=20, ge=0, lt=50),
     fullcontent: bool = Query(default=False)):
-    collection: LmdbmDocumentCollection = LmdbmDocumentCollection(f"data/{name}.crawl")
+    collection = get_collection(name)
+    try:
+        return browse_page(name, collection, page, rows, fullcontent)
+    except lmdb.MapResizedError:
+        # a crawl in another process grew the map since the collection was opened
+        collection.adopt_map_size()
+        return browse_page(name, collection, page, rows, fullcontent)
+
 
-    items = list(collection.filter_keys("type", "content"))    
+def browse_page(name: str, collection: LmdbmDocumentCollection, page: int, rows: int, fullcontent: bool) -> dict:
+    items = get_content_keys(name, collection)
 
     per_page = rows  # Number of items per page
     start = page * per_page  # Calculate start and end for slicing
@@ -76,6 +127,7 @@ async def browse_results(
         if not fullcontent:
             del obj['_content']
         del obj['parsed_hash']
+        obj.pop('body_hash', None)
         del obj['crawled']
         del obj['type']
         item_return_obj.append(obj)
@@ -117,5 +169,9 @@ def monitor_tasks():
         recv.capture(limit=None, timeout=None, wakeup=True)
 
 
-task_monitor_thread = threading.Thread(target=monitor_tasks)
-task_monitor_thread.start()
+task_monitor_thread = threading.Thread(target=monitor_tasks, daemon=True)
+
+
+@app.on_event("startup")
+def start_task_monitor():
+    task_monitor_thread.start()
@@ -13,7 +13,7 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/tapanpandita/aiocrawler",
     license="MIT",
-    install_requires=["aiohttp", "beautifulsoup4", "cchardet", "aiodns"],
+    install_requires=["aiohttp", "charset-normalizer", "xxhash", "orjson", "beautifulsoup4", "cchardet", "aiodns"],
     py_modules=["aiocrawler"],
     zip_safe=True,
     classifiers=[
@@ -1,37 +1,112 @@
-import json
 import logging
+import math
+import multiprocessing
 import os.path
 import re
+import threading
 import time
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Optional
-from typing import Set, Tuple, Union
+from typing import List, Tuple, Union
 
+import orjson
 import xxhash
 from celery.result import AsyncResult
 from multidict import CIMultiDictProxy, CIMultiDict
-from pydantic import BaseModel
-from selectolax.parser import HTMLParser, Node
+from pydantic import BaseModel, PrivateAttr
+from selectolax.lexbor import LexborHTMLParser as HTMLParser, LexborNode as Node
 from tldextract import tldextract
 from usp.tree import sitemap_tree_for_homepage
 
-from aiocrawler import AsyncCrawler
+from aiocrawler import AsyncCrawler, AlreadyFetchedError
 from lmdb_collection import LmdbmDocumentCollection
 
 import urllib.parse as urlparse
 import uuid
 
-from lxml.html.clean import Cleaner
 import requests
 
-global_excludes = {"\\.jpg", "\\.jpeg", "\\.png", "\\.mp4", "\\.webp", "\\.gif", "\\.css", "\\.js"}
+# never crawled, unless allowed_regex says otherwise; matched case-insensitively against the end of the url path
+global_excluded_extensions = (".jpg", ".jpeg", ".png", ".mp4", ".webp", ".gif", ".css", ".js")
 logger = logging.getLogger('SiteCrawler')
 
 is_clean_javascript = True
 is_clean_style = True
 kill_tags = ['noscript','footer', 'header', 'nav', 'button', 'form']
 unstructured_url = 'http://localhost:8005'
+unstructured_concurrency = 8
+extraction_chunk_size = 256
+# document ids are uuid3 of the url; False switches to faster xxh128 based ids, which changes every document's id
+is_uuid3_id = True
+_no_headers = CIMultiDictProxy(CIMultiDict())
+
+# the public suffix list snapshot bundled with tldextract, so that no suffix list is fetched over the network.
+# Private suffixes such as github.io are included, so that foo.github.io is its own registered domain.
+_tld_extract = tldextract.TLDExtract(suffix_list_urls=(), include_psl_private_domains=True)
+
+
+def _compile_union(patterns: list) -> Optional[re.Pattern]:
+    """
+    Compiles the patterns into a single case-insensitive alternation, so that a url is tested
+    against all of them with one search. Returns None if there are no patterns.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+
+
+# a pattern that only anchors a literal to the end of the url, such as ".html$" or "\.pdf$"
+_suffix_pattern = re.compile(r"(\\\.|\.)?([A-Za-z0-9_/-]+)\$")
+
+
+def _split_suffix_patterns(patterns: list) -> tuple[tuple[str, ...], list]:
+    """
+    Separates the patterns that only test how a url ends from the rest. Those are checked with a single
+    str.endswith on the lowercased url, which is much cheaper than a regex search.
+    """
+    suffixes, rest = [], []
+    for p in patterns:
+        m = _suffix_pattern.fullmatch(p)
+        if m is None:
+            rest.append(p)
+        else:
+            # an escaped dot is part of the suffix, while a bare one matches any character, which a url always has
+            suffixes.append(("." if m.group(1) == "\\." else "") + m.group(2).lower())
+    return tuple(suffixes), rest
+
+
+@lru_cache(maxsize=200_000)
+def _parse_host(netloc: str) -> tuple[str, str]:
+    """
+    Returns (hostname, registered domain) for a netloc. Cached because a crawl sees millions of links
+    but only a few thousand distinct hosts, and the public-suffix lookup is the slow part of valid_link.
+    """
+    link_tld = _tld_extract(netloc)
+    tld = link_tld.domain + "." + link_tld.suffix
+    return link_tld.subdomain + "." + tld, tld
+
+
+def _sitemap_urls(homepage: str) -> list[str]:
+    logger.info("Fetching sitemap for %s", homepage)
+    tree = sitemap_tree_for_homepage(homepage)
+    return [page.url for page in tree.all_pages()]
+
+
+def _fetch_sitemap_urls(homepages: list[str]) -> set[str]:
+    """
+    Returns the page urls listed in the sitemaps of all the homepages. The sitemaps are fetched
+    in parallel, as sitemap_tree_for_homepage blocks on the network for each one.
+    """
+    leaf_urls = set()
+    with ThreadPoolExecutor(max_workers=min(16, len(homepages) or 1)) as executor:
+        for urls in executor.map(_sitemap_urls, homepages):
+            leaf_urls.update(urls)
+    return leaf_urls
+
 
 class ExtractionRule(BaseModel):
     field_name: str
@@ -45,14 +120,37 @@ class ExtractionRule(BaseModel):
 
 class ExtractionRules(BaseModel):
     rules: list[ExtractionRule]
+    _patterns: dict[str, re.Pattern] = PrivateAttr(default_factory=dict)
+    _hash: Optional[int] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context) -> None:
+        # compile up front, so that a bad regex fails when the crawler is configured rather than mid-extraction
+        for r in self.rules:
+            if r.regex:
+                self.pattern(r.regex)
+
+    def pattern(self, regex: str) -> re.Pattern:
+        """
+        Returns the compiled pattern for a rule's regex, compiling it on first use only.
+        """
+        pattern = self._patterns.get(regex)
+        if pattern is None:
+            pattern = self._patterns[regex] = re.compile(regex)
+        return pattern
 
     def compute_hash(self):
-        return xxhash.xxh32_intdigest(json.dumps([k.model_dump_json() for k in self.rules]))
+        """
+        Hash of the rules, memoized as the rules are fixed once the crawler is configured.
+        """
+        if self._hash is None:
+            self._hash = xxhash.xxh3_64_intdigest(self.model_dump_json())
+        return self._hash
 
 
 class SiteCrawler(AsyncCrawler):
     timeout = 10
     max_redirects = 2
+    progress_interval = 1.0  # minimum seconds between celery progress updates
     
 
     def __init__(self,
@@ -89,12 +187,7 @@ class SiteCrawler(AsyncCrawler):
 
         if is_sitemap:
             max_depth = 1
-            leaf_urls = set()
-            for s in starting_urls:
-                logger.info("Fetching sitemap for %s", s)
-                tree = sitemap_tree_for_homepage(s)
-                for page in tree.all_pages():
-                    leaf_urls.add(page.url)
+            leaf_urls = _fetch_sitemap_urls(starting_urls)
             super().__init__(starting_urls=list(leaf_urls), max_depth=max_depth,
                              max_pages=max_pages,
                              concurrency=concurrency,
@@ -122,27 +215,34 @@ class SiteCrawler(AsyncCrawler):
         if extraction_rules is None:
             extraction_rules = ExtractionRules(rules=[])
 
-        self.allowed_domains = allowed_domains
+        self.allowed_domains = set(allowed_domains)
         self.allowed_regex = allowed_regex
-        self.denied_regex = denied_regex + list(global_excludes)
+        self.denied_regex = denied_regex
         self.denied_extensions = denied_extensions
+        self._allowed_suffixes, allowed_patterns = _split_suffix_patterns(self.allowed_regex)
+        self._allowed_re = _compile_union(allowed_patterns)
+        self._denied_re = _compile_union(self.denied_regex)
+        self._denied_extensions = tuple(self.denied_extensions)
 
         if isinstance(extraction_rules, str):
             self.extraction_rules = ExtractionRules.model_validate_json(extraction_rules)
         elif isinstance(extraction_rules, dict):
-            self.extraction_rules = ExtractionRules.model_validate_json(json.dumps(extraction_rules))
+            self.extraction_rules = ExtractionRules.model_validate(extraction_rules)
         elif isinstance(extraction_rules, ExtractionRules):
             self.extraction_rules = extraction_rules
 
         self.cache_ttl_hours = cache_ttl_hours
+        self._cache_ttl_seconds = cache_ttl_hours * 3600 if cache_ttl_hours > -1 else None
         self.stats = Counter()
 
         for s in starting_urls:
             subdomain, tld = self.parse_tld(s)
             if allow_starting_url_hostname:
-                self.allowed_domains.append(subdomain)
+                self.allowed_domains.add(subdomain)
             if allow_starting_url_tld:
-                self.allowed_domains.append(tld)
+                self.allowed_domains.add(tld)
+        # any host under an allowed registered domain is allowed, which a suffix test can tell without a TLD lookup
+        self._allowed_domain_suffixes = tuple("." + d for d in self.allowed_domains if _parse_host(d)[1] == d)
         self.name = name
         self.max_pages = max_pages
         self.max_redirects = 30
@@ -151,6 +251,7 @@ class SiteCrawler(AsyncCrawler):
         self.end_time = -1
         self.duration = -1
         self.celery_task: Optional[AsyncResult] = None
+        self._last_progress = 0.0
 
         if init_collection:
             if not os.path.exists(data_dir):
@@ -162,39 +263,23 @@ class SiteCrawler(AsyncCrawler):
 
     @classmethod
     def from_json(cls, json_str: str, **kwargs) -> 'SiteCrawler':
-        return cls(**json.loads(json_str), **kwargs)
+        return cls(**orjson.loads(json_str), **kwargs)
 
     @staticmethod
     def format_duration(seconds):
         if seconds < 1:
             return "less than a second"
 
-        words = ["year", "day", "hour", "minute", "second"]
-
-        if not seconds:
-            return "now"
-        else:
-            m, s = divmod(seconds, 60)
-            h, m = divmod(m, 60)
-            d, h = divmod(h, 24)
-            y, d = divmod(d, 365)
-
-            time = [y, d, h, m, s]
-
-            duration = []
+        m, s = divmod(seconds, 60)
+        h, m = divmod(m, 60)
+        d, h = divmod(h, 24)
+        y, d = divmod(d, 365)
 
-            for x, i in enumerate(time):
-                if i == 1:
-                    duration.append(f"{i} {words[x]}")
-                elif i > 1:
-                    duration.append(f"{i} {words[x]}s")
-
-            if len(duration) == 1:
-                return duration[0]
-            elif len(duration) == 2:
-                return f"{duration[0]} and {duration[1]}"
-            else:
-                return ", ".join(duration[:-1]) + " and " + duration[-1]
+        duration = [f"{i} {word}" if i == 1 else f"{i} {word}s"
+                    for i, word in zip((y, d, h, m, s), ("year", "day", "hour", "minute", "second")) if i >= 1]
+        if len(duration) == 1:
+            return duration[0]
+        return ", ".join(duration[:-1]) + " and " + duration[-1]
 
     def report(self):
         start_time = datetime.fromtimestamp(self.start_time, timezone.utc).astimezone().strftime(
@@ -216,38 +301,51 @@ class SiteCrawler(AsyncCrawler):
         """
         self.stats["total"] += 1
 
-        if self.is_cached_url(url):
+        entry = self._get_entry(url)
+        if self._is_cached_entry(entry):
             # logger.debug("Cached: " + url)
             self.stats["cached"] += 1
-            if self.celery_task:
-                self.celery_task.update_state(state='PROGRESS', meta={"name": self.name, "stats": self.stats})
-            dict = CIMultiDict()
-            cached = self.collection[url]
-            dict["Last-Modified"] = cached["server_last_modified"]
-            return cached["content_type"], url, cached["_content"], CIMultiDictProxy(dict)
-        elif self.is_redirected_url(url):
-            # logger.debug("Cached[redirected]: " + url)
-            self.stats["cached_redirects"] += 1
-            actual_url = self.get_redirected_url(url)
-            dict = CIMultiDict()
-            cached = self.collection[actual_url]
-            dict["Last-Modified"] = cached["server_last_modified"]
-            return cached["content_type"], actual_url, cached["_content"], CIMultiDictProxy(dict)
-        else:
-            print(f"Fetching {url}")
+            self.report_progress()
+            return self._build_cached_response(url, entry)
+        if entry is not None and entry["type"] == "redirect":
+            # the redirect's target may never have been stored, e.g. as its content type isn't crawled,
+            # in which case the url is fetched again
+            target = self._get_entry(entry["redirected_url"])
+            if self._is_cached_entry(target):
+                # logger.debug("Cached[redirected]: " + url)
+                self.stats["cached_redirects"] += 1
+                return self._build_cached_response(entry["redirected_url"], target)
+
+        logger.debug("Fetching %s", url)
 
         self.stats["fetched"] += 1
-        content_type, actual_url, content, headers = await super()._make_request(url)
-        if self.celery_task:
-            self.celery_task.update_state(state='PROGRESS', meta={"name": self.name, "stats": self.stats})
+        try:
+            content_type, actual_url, content, headers = await super()._make_request(url)
+        except AlreadyFetchedError as excp:
+            # the target is crawled on its own, but the redirect is still recorded so that recrawls
+            # answer it from the cache, provided the target gets stored
+            self.save_redirect(url, excp.actual_url)
+            raise
+        self.report_progress()
         if url != actual_url:
             self.save_redirect(url, actual_url)
         return content_type, actual_url, content, headers
 
+    @staticmethod
+    def _build_cached_response(url: str, entry: dict) -> Tuple[str, str, Union[str, bytes], CIMultiDictProxy[str]]:
+        """
+        Builds the _make_request result for a cached document. Only Last-Modified is replayed, and
+        documents without one share a single empty header proxy.
+        """
+        last_modified = entry.get("server_last_modified")
+        if last_modified is None:
+            headers = _no_headers
+        else:
+            headers = CIMultiDictProxy(CIMultiDict({"Last-Modified": last_modified}))
+        return entry["content_type"], url, entry["_content"], headers
+
     def parse_tld(self, url: str) -> tuple[str, str]:
-        link_tld = tldextract.extract(url)
-        tld = link_tld.domain + "." + link_tld.suffix
-        return link_tld.subdomain + "." + tld, tld
+        return _parse_host(urlparse.urlsplit(url).netloc)
 
     def valid_link(self, source_url: str, link: str):
         """
@@ -256,32 +354,30 @@ class SiteCrawler(AsyncCrawler):
         :param link:
         :return:
         """
-        subdomain, tld = self.parse_tld(link)
-        if subdomain not in self.allowed_domains and tld not in self.allowed_domains:
+        # cheap string checks first, so that the links they reject never reach the host lookup
+        if not link.startswith(("http://", "https://")) or "@" in link:
             return False
-        if "@" in link:
+        if not self.allowed_regex and link.endswith(self._denied_extensions):
+            # with no allow rules, nothing can override a denied extension
             return False
 
-        included = False
-        for s in self.allowed_regex:
-            if re.findall(s, link, re.IGNORECASE):
-                included = True
-                break
-        if included:
+        split = urlparse.urlsplit(link)
+        netloc = split.netloc
+        if netloc not in self.allowed_domains and not netloc.endswith(self._allowed_domain_suffixes):
+            subdomain, tld = _parse_host(netloc)
+            if subdomain not in self.allowed_domains and tld not in self.allowed_domains:
+                return False
+
+        if self._allowed_suffixes and link.lower().endswith(self._allowed_suffixes):
+            return True
+        if self._allowed_re is not None and self._allowed_re.search(link):
             return True
 
-        excluded = False
-        for s in self.denied_regex:
-            if re.findall(s, link, re.IGNORECASE):
-                excluded = True
-                break
-        if excluded:
+        if split.path.lower().endswith(global_excluded_extensions):
             return False
-        for s in self.denied_extensions:
-            if link.endswith(s):
-                excluded = True
-                break
-        if excluded:
+        if self._denied_re is not None and self._denied_re.search(link):
+            return False
+        if link.endswith(self._denied_extensions):
             return False
 
         # ======================================================
@@ -292,16 +388,26 @@ class SiteCrawler(AsyncCrawler):
 
         return True
 
-    def is_cached_url(self, url):
-        is_cached = url in self.collection and self.collection[url]["type"] == "content"
-        if is_cached and self.cache_ttl_hours > -1:
-            is_cache_expired = (self.start_time - self.collection[url]["crawled"]) / 3600 >= self.cache_ttl_hours
+    def _get_entry(self, url) -> Optional[dict]:
+        """
+        Fetches the stored document for url in a single lookup, or None if there is none.
+        """
+        return self.collection.get(url)
+
+    def _is_cached_entry(self, entry: Optional[dict]) -> bool:
+        is_cached = entry is not None and entry["type"] == "content"
+        if is_cached and self._cache_ttl_seconds is not None:
+            is_cache_expired = self.start_time - entry["crawled"] >= self._cache_ttl_seconds
             return not is_cache_expired
         else:
             return is_cached
 
+    def is_cached_url(self, url):
+        return self._is_cached_entry(self._get_entry(url))
+
     def is_redirected_url(self, url):
-        return url in self.collection and self.collection[url]["type"] == "redirect"
+        entry = self._get_entry(url)
+        return entry is not None and entry["type"] == "redirect"
 
     def get_redirected_url(self, url):
         return self.collection[url]["redirected_url"]
@@ -314,7 +420,12 @@ class SiteCrawler(AsyncCrawler):
         self.collection.add(url, error_message, type="error", error_code=error_code)
         logging.error(f'{url}, {error_code}, {error_message}')
 
-    def output(self, content_type: str, url: str, links: Set[str], content: Union[str, bytes],
+    def log_skipped_url(self, url, reason: str, message: str):
+        # counted, but not stored as an error, so that a previously crawled copy of the page is kept
+        self.stats[reason] += 1
+        logger.warning(message)
+
+    def output(self, content_type: str, url: str, links: List[str], content: Union[str, bytes],
                response_headers: CIMultiDictProxy[str]) -> Optional[Tuple[str, str]]:
         """
         Write the content to the LMDB collection.
@@ -326,36 +437,52 @@ class SiteCrawler(AsyncCrawler):
         :return:
         """
         try:
-            if not self.is_cached_url(url):
+            cached = self._get_entry(url)
+            body_hash = xxhash.xxh3_64_intdigest(content)
+            server_last_modified = response_headers.get("Last-Modified")
+            now = time.time()
+            if cached is not None and cached["type"] == "content" and cached.get("body_hash") == body_hash:
+                # same body as the stored copy: keep it, along with whatever was extracted from it
+                if not self._is_cached_entry(cached):
+                    self.stats["unchanged"] += 1
+                    self.collection.update_properties(url, crawled=now,
+                                                      server_last_modified=server_last_modified)
+            elif not self._is_cached_entry(cached) or (
+                    server_last_modified and cached["server_last_modified"] != server_last_modified):
+                # new, expired, or modified on the server since it was cached
                 self.stats["new_or_updated"] += 1
                 if content_type == "text/html":
-                    self.collection.add_html(url, content, type="content", parsed_hash="", crawled=time.time(),
-                                             server_last_modified=response_headers.get("Last-Modified"))
+                    self.collection.add_html(url, content, type="content", parsed_hash="", crawled=now,
+                                             server_last_modified=server_last_modified, body_hash=body_hash)
                 else:
                     self.collection.add_binary(url, content, content_type, type="content", parsed_hash="",
-                                               crawled=time.time(), server_last_modified=response_headers.get("Last-Modified"))
-            else:
-                # compare the last modified dates
-                server_last_modified = response_headers.get("Last-Modified")
-                cached = self.collection[url]
-                if server_last_modified and cached["server_last_modified"] != server_last_modified:
-                    self.stats["new_or_updated"] += 1
-                    if content_type == "text/html":
-                        self.collection.add_html(url, content, type="content", parsed_hash="", crawled=time.time(),
-                                                 server_last_modified=response_headers.get("Last-Modified"))
-                    else:
-                        self.collection.add_binary(url, content, content_type, type="content", parsed_hash="",
-                                                   crawled=time.time(),
-                                                   server_last_modified=response_headers.get("Last-Modified"))
+                                               crawled=now, server_last_modified=server_last_modified,
+                                               body_hash=body_hash)
+                self.collection.mark_unparsed(url)
 
         except Exception as e:
             print("Error saving", url, e)
         return None
 
+    async def crawl(self) -> None:
+        with self.collection.batch():
+            await super().crawl()
+
     def crawl_completed(self):
         self.end_time = time.time()
         self.duration = self.end_time - self.start_time
 
+    def report_progress(self) -> None:
+        """
+        Publishes the stats to the attached celery task, at most once every progress_interval seconds,
+        as each update is a write to the result backend.
+        """
+        if self.celery_task:
+            now = time.monotonic()
+            if now - self._last_progress >= self.progress_interval:
+                self._last_progress = now
+                self.celery_task.update_state(state='PROGRESS', meta={"name": self.name, "stats": self.stats})
+
     def attach_celery_task(self, current_task):
         self.celery_task = current_task
 
@@ -368,7 +495,8 @@ def _extract_content(node: Node, rule: ExtractionRule) -> str:
 
 
 def do_extract(content: str, rules: ExtractionRules) -> dict:
-    dom = HTMLParser(dom_cleaner(content))
+    dom = HTMLParser(content)
+    dom.strip_tags(_stripped_tags(), recursive=True)
     result = {}
     for r in rules.rules:
         if r.css:
@@ -381,16 +509,17 @@ def do_extract(content: str, rules: ExtractionRules) -> dict:
             elif len(results) > 1:
                 result[r.field_name] = [_extract_content(n, r) for n in results]
         elif r.regex:
-            matches = re.findall(r.regex, content)
-            if len(matches) > 0:
-                result[r.field_name] = matches[0].strip()
+            # only the first match is used: the first group if the regex has one, else the whole match
+            match = rules.pattern(r.regex).search(content)
+            if match:
+                result[r.field_name] = (match.group(1 if match.re.groups else 0) or "").strip()
         elif r.fixed_value:
             result[r.field_name] = r.fixed_value
         if r.field_name not in result:
             result[r.field_name] = ""
     return result
 
-def _extract_binary_content(result, bytestream):
+def _extract_binary_content(result, bytestream, session=requests):
     headers = {
         'accept': 'application/json'
     }
@@ -400,7 +529,7 @@ def _extract_binary_content(result, bytestream):
         'files' : (filename, bytestream),
         'strategy': (None,'auto')
     }
-    resp = requests.post(f'{unstructured_url}/general/v0/general', headers=headers, files=files)
+    resp = session.post(f'{unstructured_url}/general/v0/general', headers=headers, files=files)
     if resp.status_code == 200:
         text_blob = ' '.join([line['text'] for line in resp.json()])
         title = resp.json()[0]['metadata']['filename']
@@ -410,62 +539,171 @@ def _extract_binary_content(result, bytestream):
 
 
 
-def do_extraction(crawler):
+_worker_rules: Optional[ExtractionRules] = None
+
+
+def _init_extraction_worker(rules: ExtractionRules) -> None:
+    global _worker_rules
+    _worker_rules = rules
+
+
+def _extract_document(key: str, content: str, rules: ExtractionRules = None) -> dict:
+    result = do_extract(content, rules or _worker_rules)
+    # Default extraction for Facet on Based on URL
+    result['uri'] = key
+    url_parse = urlparse.urlparse(key)
+    result['path_s'] = get_path(url_parse)
+    result['typeUrl_s'] = get_type_from_url(url_parse)
+    result['id'] = create_id(key)
+    return result
+
+
+def do_extraction(crawler, processes: Optional[int] = None):
+    """
+    Runs the extraction rules over every document not yet parsed with them.
+    HTML parsing is CPU bound, so documents are parsed in chunks on a pool of `processes` processes
+    (default: one per CPU, but no more than there are chunks of documents to parse). Celery's prefork workers are daemonic and cannot start a pool, so they
+    parse in-process, as does processes=1.
+    """
     if crawler.extraction_rules is None or len(crawler.extraction_rules.rules) == 0:
         return
     parsed_hash = crawler.extraction_rules.compute_hash()
-
-    for k, v in crawler.collection.items():
-        if crawler.collection.is_binary_key(k):
-            continue
+    # after a first full pass, only the documents written since then need to be looked at
+    unparsed_keys = crawler.collection.unparsed_keys(parsed_hash)
+    if processes is None:
+        processes = 1 if multiprocessing.current_process().daemon else os.cpu_count() or 1
+        if unparsed_keys is not None:
+            # no more processes than there are chunks to hand them, as each one costs a fork and an import
+            processes = max(1, min(processes, math.ceil(len(unparsed_keys) / extraction_chunk_size)))
+    if unparsed_keys is None:
+        # the index is read before the documents, so that whatever is marked during the pass stays marked
+        marks = crawler.collection.unparsed_marks()
+        crawler.collection.prefetch()
+        candidates = crawler.collection.items()
+    else:
+        marks = unparsed_keys
+        candidates = ((k, crawler.collection.get(k)) for k in unparsed_keys)
+    # binary documents are uploaded to unstructured on a pool of threads, as each upload is a slow
+    # round trip; pending uploads are bounded so that only a few payloads are held in memory at once
+    pending = deque()
+    # requests.Session is not thread-safe, so each upload thread keeps its own
+    thread_local = threading.local()
+    sessions = []
+
+    def open_session():
+        thread_local.session = requests.Session()
+        sessions.append(thread_local.session)
+
+    def upload(result, bytestream):
+        return _extract_binary_content(result, bytestream, thread_local.session)
+
+    def save(k, v, result):
+        v.update(result)
+        v["parsed_hash"] = parsed_hash
+        crawler.collection[k] = v
+
+    def extract_chunk(docs):
+        keys = [k for k, v in docs]
+        contents = [v["_content"] for k, v in docs]
+        if parse_pool is None:
+            results = map(_extract_document, keys, contents, [crawler.extraction_rules] * len(docs))
         else:
-            if v["type"] == "content" and v["parsed_hash"] != parsed_hash:
-                result = do_extract(v["_content"], crawler.extraction_rules)
-                # Default extraction for Facet on Based on URL
-                result['uri'] = k
-                result['path_s'] = get_path(k)
-                result['typeUrl_s'] = get_type_from_url(k)
-                result['id'] = create_id(k)
-
-                if v['content_type'] != 'text/html':
-                    result = _extract_binary_content(result, crawler.collection.get_binary(k))
-                v.update(result)
-                # print(k, result)
-                v["parsed_hash"] = parsed_hash
-                crawler.collection[k] = v
-
-def dom_cleaner(content):
-    cleaner = Cleaner()
-    cleaner.javascript = is_clean_javascript
-    cleaner.style = is_clean_style
-    cleaner.kill_tags = kill_tags
-
-    return cleaner.clean_html(content)
+            results = parse_pool.map(_extract_document, keys, contents,
+                                     chunksize=max(1, len(docs) // (4 * processes)))
+        for (k, v), result in zip(docs, results):
+            if v['content_type'] != 'text/html':
+                future = executor.submit(upload, result, crawler.collection.get_binary(k))
+                pending.append((k, v, future))
+                if len(pending) >= 2 * unstructured_concurrency:
+                    done_k, done_v, done = pending.popleft()
+                    save(done_k, done_v, done.result())
+            else:
+                save(k, v, result)
+
+    parse_pool_context = nullcontext()
+    if processes > 1:
+        parse_pool_context = ProcessPoolExecutor(processes, initializer=_init_extraction_worker,
+                                                 initargs=(crawler.extraction_rules,))
+    try:
+        with crawler.collection.batch(), \
+                ThreadPoolExecutor(max_workers=unstructured_concurrency, initializer=open_session) as executor, \
+                parse_pool_context as parse_pool:
+            docs = []
+            for k, v in candidates:
+                # binary payloads are read through their document, and documents already parsed with these
+                # rules are skipped before any HTML is touched
+                if crawler.collection.is_binary_key(k) or v is None or v["type"] != "content" \
+                        or v["parsed_hash"] == parsed_hash:
+                    continue
+                docs.append((k, v))
+                if len(docs) >= extraction_chunk_size:
+                    extract_chunk(docs)
+                    docs = []
+            extract_chunk(docs)
+            while pending:
+                k, v, future = pending.popleft()
+                save(k, v, future.result())
+    finally:
+        for session in sessions:
+            session.close()
+    # including the keys that were skipped, e.g. as they are no longer content, so they aren't read again
+    crawler.collection.mark_parsed(marks, full_pass_hash=parsed_hash if unparsed_keys is None else None)
+
+
+def _stripped_tags() -> list[str]:
+    """
+    Tags removed, along with their content, before the CSS rules are applied.
+    """
+    tags = list(kill_tags)
+    if is_clean_javascript:
+        tags.append("script")
+    if is_clean_style:
+        tags.append("style")
+    return tags
 
 def create_id(url_string):
-    return str(uuid.uuid3(uuid.NAMESPACE_URL, url_string))
+    if is_uuid3_id:
+        return str(uuid.uuid3(uuid.NAMESPACE_URL, url_string))
+    h = xxhash.xxh128_hexdigest(url_string)
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
 
-def get_path(url_string):
-    url_parse = urlparse.urlparse(url_string)
+def get_path(url_string: Union[str, urlparse.ParseResult]):
+    url_parse = urlparse.urlparse(url_string) if isinstance(url_string, str) else url_string
     path_str = url_parse.path.strip('/').replace('/', ' / ')
     if not path_str:
         path_str = url_parse.netloc
     return path_str
 
-def get_type_from_url(url_string):
-    url_parse = urlparse.urlparse(url_string)
-    pagetype = url_parse.path.strip('/').split('/')[0].title()
-    if "-" in pagetype:
-        pagetype = " ".join(pagetype.split("-")).title()
-    if "_" in pagetype:
-        pagetype = " ".join(pagetype.split("_")).title()
-    if not pagetype:
+def get_type_from_url(url_string: Union[str, urlparse.ParseResult]):
+    url_parse = urlparse.urlparse(url_string) if isinstance(url_string, str) else url_string
+    return _type_from_segment(url_parse.path.strip('/').split('/', 1)[0])
+
+_type_separators = re.compile(r"[-_]")
+
+@lru_cache(maxsize=4096)
+def _type_from_segment(segment: str) -> str:
+    # cached, as the pages of a site fall into a handful of top-level sections
+    if not segment:
         return "Web Page"
-    return pagetype
+    return _type_separators.sub(" ", segment).title()
+
+
+def run_event_loop(main):
+    """
+    Runs the coroutine main to completion like asyncio.run(), on uvloop: a faster event loop than
+    asyncio's default for the crawler's network I/O. uvloop does not support Windows, where
+    asyncio's loop is used instead.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        import asyncio
+        return asyncio.run(main)
+    return uvloop.run(main)
+
 
 if __name__ == '__main__':
     import sys
-    import asyncio
     from collections import defaultdict
 
     d = defaultdict(list)
@@ -475,6 +713,6 @@ if __name__ == '__main__':
         d[k] = d[k][0]
     print("Sitecrawler parameters:", d)
     crawler = SiteCrawler(**dict(d))
-    asyncio.run(crawler.get_results())
+    run_event_loop(crawler.get_results())
     print(crawler.stats)
     do_extraction(crawler)
@@ -1,4 +1,3 @@
-import asyncio
 import json
 import os
 from contextlib import contextmanager
@@ -7,7 +6,7 @@ from typing import Union
 from celery import Celery, current_task
 from dotenv import load_dotenv
 
-from sitecrawler import SiteCrawler, do_extraction
+from sitecrawler import SiteCrawler, do_extraction, run_event_loop
 
 load_dotenv()
 
@@ -40,7 +39,7 @@ def start_crawl(json_spec: Union[dict, str]):
         crawler = SiteCrawler(**settings)
 
         crawler.attach_celery_task(current_task)
-        asyncio.run(crawler.get_results())
+        run_event_loop(crawler.get_results())
         print(crawler.stats)
         start_extraction.delay(json_spec)
         return crawler.report()
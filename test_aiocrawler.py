@@ -1,216 +1,163 @@
-import pytest  # type: ignore
 import asyncio
-import aiocrawler
-from aiocrawler import (
-    AIOCrawler,
-    SitemapCrawler,
-    InvalidContentTypeError,
-    TaskQueueMessage,
-)
-
-
-@pytest.fixture
-def crawler():
-    url = 'https://www.example.com'
-    crawler = AIOCrawler(url)
-    return crawler
-
-
-@pytest.fixture
-def html():
-    html_string = '''
-    <html>
-    <body>
-        <a href="https://www.example.com/about">Test 1</a>
-        <a href="https://api.example.com/docs">Test 2</a>
-        <a href="/careers">Test 3</a>
-    </body>
-    </html>
-    '''
-    return html_string
-
-
-@pytest.fixture
-def create_mock_coroutine(mocker, monkeypatch):
-    def _create_mock_patch_coro(to_patch=None):
-        mock = mocker.Mock()
-
-        async def _coro(*args, **kwargs):
-            return mock(*args, **kwargs)
-
-        if to_patch:
-            monkeypatch.setattr(to_patch, _coro)
-
-        return mock, _coro
-
-    return _create_mock_patch_coro
-
-
-@pytest.fixture
-def mock_make_request(monkeypatch, html):
-    async def mock_make_request(*args, **kwargs):
-        return html
-
-    monkeypatch.setattr(AIOCrawler, '_make_request', mock_make_request)
-
-
-@pytest.fixture
-def mock_make_request_generic(create_mock_coroutine):
-    mock_make_request, mock_coroutine = create_mock_coroutine(
-        to_patch='aiocrawler.AIOCrawler._make_request'
-    )
-    return mock_make_request
-
-
-@pytest.fixture
-def mock_queue(mocker, monkeypatch):
-    queue = mocker.Mock()
-    monkeypatch.setattr(asyncio, 'Queue', queue)
-    return queue.return_value
-
-
-@pytest.fixture
-def mock_put_nowait(mock_queue, create_mock_coroutine):
-    mock_put, coro_put = create_mock_coroutine()
-    mock_queue.put_nowait = coro_put
-    return mock_put
-
-
-@pytest.fixture
-def mock_join(mock_queue, create_mock_coroutine):
-    mock_join, coro_join = create_mock_coroutine()
-    mock_queue.join = coro_join
-    return mock_join
-
-
-def test_task_queue_message():
-    url = 'https://www.example.com'
-    depth = 5
-    retry_count = 3
-    task_message = TaskQueueMessage(url, depth, retry_count)
-    assert task_message.url == url
-    assert task_message.depth == depth
-    assert task_message.retry_count == retry_count
-
-
-def test_initial_default_depth(crawler):
-    assert crawler.depth == 1
-
-
-def test_initial_default_concurrency(crawler):
-    assert crawler.concurrency == 100
-
-
-def test_initial_default_max_retries(crawler):
-    assert crawler.max_retries == 2
-
-
-def test_initial_default_user_agent(crawler):
-    assert crawler.user_agent == 'AIOCrawler'
-
-
-def test_initial_crawled_urls(crawler):
-    assert isinstance(crawler.crawled_urls, set)
-    assert not crawler.crawled_urls
-
-
-def test_initial_results(crawler):
-    assert isinstance(crawler.results, list)
-    assert not crawler.results
-
-
-def test_base_url(crawler):
-    assert crawler.base_url == 'https://www.example.com'
-
-
-def test_setting_initial_url(crawler):
-    url = 'https://www.example.com'
-    assert crawler.init_url == url
-
-
-def test_setting_depth():
-    depth = 5
-    url = 'https://www.example.com'
-    crawler = AIOCrawler(url, depth=depth)
-    assert crawler.depth == depth
-
-
-def test_setting_concurrency():
-    concurrency = 250
-    url = 'https://www.example.com'
-    crawler = AIOCrawler(url, concurrency=concurrency)
-    assert crawler.concurrency == concurrency
-
-
-def test_setting_max_retries():
-    max_retries = 5
-    url = 'https://www.example.com'
-    crawler = AIOCrawler(url, max_retries=max_retries)
-    assert crawler.max_retries == max_retries
-
-
-def test_setting_user_agent():
-    user_agent = 'Test User Agent'
-    url = 'https://www.example.com'
-    crawler = AIOCrawler(url, user_agent=user_agent)
-    assert crawler.user_agent == user_agent
-
-
-def test_find_links(html, crawler):
-    links = crawler.find_links(html)
-    assert links == {'https://www.example.com/about', 'https://www.example.com/careers'}
-
-
-@pytest.mark.asyncio
-async def test_crawl_page(mock_make_request, crawler, html):
-    url = 'https://www.example.com'
-    url, links, html = await crawler.crawl_page(url)
-    assert url == url
-    assert links == {'https://www.example.com/about', 'https://www.example.com/careers'}
-    assert html == html
-
-
-# @pytest.mark.asyncio
-# async def test_retry_task(crawler):
-# task_message = TaskQueueMessage('https://www.example.com', 2, 1)
-# await crawler.retry_task(task_message)
-# assert crawler.task_queue.qsize() == 1
-
-
-# @pytest.mark.asyncio
-# async def test_retry_task_with_max_retries_exceeded(crawler):
-# task_message = TaskQueueMessage('https://www.example.com', 2, 5)
-# await crawler.retry_task(task_message)
-# assert crawler.task_queue.qsize() == 0
-
-
-def test_parse_raises_not_implemented(crawler, html):
-    url = 'https://wwww.example.com'
-    links = {'https://www.example.com/about', 'https://www.example.com/contactus'}
-
-    with pytest.raises(NotImplementedError):
-        crawler.parse(url, links, html)
-
-
-@pytest.mark.asyncio
-async def test_get_results(crawler, create_mock_coroutine):
-    mock_crawl, _ = create_mock_coroutine(to_patch='aiocrawler.AIOCrawler.crawl')
-    results = await crawler.get_results()
-    mock_crawl.assert_called_once()
-    assert results == []
-
-
-# @pytest.mark.asyncio
-# async def test_crawl(crawler, create_mock_coroutine, mock_put_nowait, mock_queue, mock_join):
-# mock_worker, _ = create_mock_coroutine(to_patch='aiocrawler.AIOCrawler.worker')
-# await crawler.crawl()
-# mock_put_nowait.assert_called_once_with(TaskQueueMessage(crawler.init_url, 0, 0))
-# mock_join.assert_called_once()
-# assert mock_worker.call_count == crawler.concurrency
-
-
-def test_sitemap_crawler_parse(html):
-    crawler = SitemapCrawler('https://www.example.com')
-    url = 'https://wwww.example.com'
-    links = {'https://www.example.com/about', 'https://www.example.com/contactus'}
-    assert crawler.parse(url, links, html) == (url, links)
+import unittest
+from collections import Counter
+from urllib.parse import urljoin, urlsplit
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from aiocrawler import AsyncCrawler, ContentTooLargeError, join_url
+
+pages = {
+    "/": '<a href="/a">A</a><a href="/b">B</a><a href="/a">A again</a><a href="/a#top">A top</a>',
+    "/a": '<a href="/">Home</a><a href="/b">B</a><a href="/c">C</a>',
+    "/b": '<a href="/a">A</a><a href="/c">C</a><a href="/missing">Missing</a>',
+    "/c": '<a href="/d">D</a>',
+    "/d": '',
+}
+
+french_html = "<html><head><title>Café</title></head><body><p>Le cœur de la ville est animé : les élèves " \
+              "déjeunent à la crêperie, près de la fenêtre. Où est la bibliothèque ? Là-bas, derrière " \
+              "l'église.</p></body></html>"
+
+
+class RecordingCrawler(AsyncCrawler):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = []
+        self.skipped = []
+
+    def output(self, content_type, url, links, content, response_headers):
+        return url
+
+    def log_error_url(self, url, error_code, error_message):
+        self.errors.append((url, error_code))
+
+    def log_skipped_url(self, url, reason, message):
+        self.skipped.append((url, reason))
+
+
+class TestJoinUrl(unittest.TestCase):
+
+    def test_join_url_matches_urljoin(self):
+        url = "https://www.example.com/docs/index.html"
+        base = urlsplit(url)
+        for href in ["https://www.example.com/about", "http://foo.example.com/a?b=1", "//cdn.example.com/x",
+                     "/careers", "/search?q=1&page=2", "contact.html", "../contact.html", "/a/./b", "/a//b",
+                     "?page=2", "/x?", "//host/x?", "http://h/x?", "/x?#top", "/x;jsessionid=1", "/;",
+                     "//", "///x", "//?", "https://", "http:///x", "http://h?", "/x\ty", "/x y"]:
+            with self.subTest(href=href):
+                self.assertEqual(urljoin(url, href).partition("#")[0], join_url(base, url, href).partition("#")[0])
+
+
+class TestAsyncCrawler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.hits = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        app = web.Application()
+        app.router.add_get("/large", self.handle_large)
+        app.router.add_get("/encoded/{charset}", self.handle_encoded)
+        app.router.add_get("/{path:.*}", self.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def handle(self, request):
+        self.hits[request.path] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        if request.path not in pages:
+            raise web.HTTPNotFound()
+        return web.Response(text=pages[request.path], content_type="text/html")
+
+    async def handle_large(self, request):
+        body = b"<html>" + b"x" * 2048 + b"</html>"
+        if "chunked" not in request.query:
+            return web.Response(body=body, content_type="text/html")
+        # streamed without a Content-Length, so only reading the body can tell its size
+        response = web.StreamResponse(headers={"Content-Type": "text/html"})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for i in range(0, len(body), 256):
+            await response.write(body[i:i + 256])
+        await response.write_eof()
+        return response
+
+    async def handle_encoded(self, request):
+        charset = request.match_info["charset"]
+        content_type = "text/html" if charset == "none" else f"text/html; charset={charset}"
+        body = french_html.encode(request.query.get("encoding", "cp1252"))
+        return web.Response(body=body, headers={"Content-Type": content_type})
+
+    def url(self, path):
+        return str(self.server.make_url(path))
+
+    async def fetch(self, crawler, path):
+        try:
+            return await crawler._make_request(self.url(path))
+        finally:
+            await crawler.session.close()
+
+    async def test_crawl_fetches_each_page_once(self):
+        crawler = RecordingCrawler([self.url("/")], max_depth=3, concurrency=4)
+        results = await crawler.get_results()
+        self.assertEqual({"/": 1, "/a": 1, "/b": 1, "/c": 1, "/missing": 1}, dict(self.hits))
+        self.assertEqual({self.url(p) for p in ("/", "/a", "/b", "/c")}, set(results))
+        self.assertEqual([(self.url("/missing"), 404)], crawler.errors)
+        self.assertEqual(0, crawler.task_queue.qsize())
+
+    async def test_crawl_respects_concurrency(self):
+        crawler = RecordingCrawler([self.url("/")], max_depth=3, concurrency=2)
+        await crawler.get_results()
+        self.assertEqual(5, sum(self.hits.values()))
+        self.assertLessEqual(self.max_in_flight, 2)
+
+    async def test_crawl_stops_at_max_depth(self):
+        crawler = RecordingCrawler([self.url("/")], max_depth=1)
+        self.assertEqual([self.url("/")], await crawler.get_results())
+        self.assertEqual({"/": 1}, dict(self.hits))
+
+    async def test_duplicate_links_are_queued_once(self):
+        crawler = RecordingCrawler([self.url("/"), self.url("/")], max_depth=2)
+        await crawler.get_results()
+        self.assertEqual({"/": 1, "/a": 1, "/b": 1}, dict(self.hits))
+
+    async def test_body_larger_than_max_content_length_is_rejected(self):
+        for path in ("/large", "/large?chunked"):
+            with self.subTest(path=path):
+                crawler = RecordingCrawler([])
+                crawler.max_content_length = 1024
+                with self.assertRaises(ContentTooLargeError):
+                    await self.fetch(crawler, path)
+
+        content_type, url, content, headers = await self.fetch(RecordingCrawler([]), "/large?chunked")
+        self.assertEqual(2061, len(content))
+
+    async def test_crawl_skips_body_larger_than_max_content_length(self):
+        crawler = RecordingCrawler([self.url("/large")])
+        crawler.max_content_length = 1024
+        self.assertEqual([], await crawler.get_results())
+        self.assertEqual([(self.url("/large"), "too_large")], crawler.skipped)
+        self.assertEqual([], crawler.errors)
+
+    async def test_body_decoding(self):
+        # a declared charset, utf-8 without one or with an unknown one, and a sniffed utf-16 body
+        for path in ("/encoded/cp1252", "/encoded/none?encoding=utf-8", "/encoded/bogus?encoding=utf-8",
+                     "/encoded/none?encoding=utf-16"):
+            with self.subTest(path=path):
+                content_type, url, content, headers = await self.fetch(RecordingCrawler([]), path)
+                self.assertEqual("text/html", content_type)
+                self.assertEqual(french_html, content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import shutil
+import tempfile
+import unittest
+
+from lmdb_collection import LmdbmDocumentCollection
+
+
+class TestLmdbmDocumentCollection(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.collection = LmdbmDocumentCollection(self.data_dir + "/testing.crawl")
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.data_dir)
+
+    def test_batch_writes_visible_by_key(self):
+        with self.collection.batch(size=10):
+            self.collection.add_html("foo", "<html></html>", type="content")
+            self.collection.add_binary("bar", b"\x00\x01", "application/pdf", type="content")
+            self.assertTrue("foo" in self.collection)
+            self.assertEqual("<html></html>", self.collection.get_content("foo"))
+            self.assertEqual(b"\x00\x01", self.collection.get_binary("bar"))
+        self.assertEqual("text/html", self.collection["foo"]["content_type"])
+        self.assertEqual(b"\x00\x01", self.collection.get_binary("bar"))
+
+    def test_batch_flushes_before_iteration(self):
+        with self.collection.batch(size=1000):
+            for i in range(25):
+                self.collection.add_html(str(i), "", type="content")
+            self.assertEqual(25, len(list(self.collection.filter_keys("type", "content"))))
+
+    def test_batch_commits_every_size_writes(self):
+        with self.collection.batch(size=10):
+            for i in range(25):
+                self.collection.add_html(str(i), "", type="content")
+            self.assertEqual(20, self.collection.db.__len__())
+        self.assertEqual(25, len(self.collection))
+
+    def test_batch_commits_once_max_bytes_are_buffered(self):
+        with self.collection.batch(size=1000, max_bytes=1000):
+            for i in range(5):
+                self.collection.add_binary(str(i), b"\x00" * 400, "application/pdf", type="content")
+            # two binaries and their documents are committed with the third binary, which takes the buffer over 1000
+            self.assertEqual(6, self.collection.db.__len__())
+        self.assertEqual(10, len(self.collection))
+
+    def test_batch_commits_after_interval(self):
+        with self.collection.batch(size=1000, interval=0.0):
+            self.collection.add_html("foo", "", type="content")
+            self.assertEqual("content", self.collection.db.get("foo")["type"])
+
+    def test_update_properties(self):
+        self.collection.add_html("foo", "<html></html>", type="content", parsed_hash="")
+        self.collection.set_property("foo", "parsed_hash", "abc")
+        self.collection.update_properties("foo", title="Foo", path_s="foo")
+        self.assertEqual({"type": "content", "parsed_hash": "abc", "title": "Foo", "path_s": "foo",
+                          "_content": "<html></html>", "content_type": "text/html"}, self.collection["foo"])
+        with self.assertRaises(KeyError):
+            self.collection.update_properties("bar", title="Bar")
+
+        with self.collection.batch():
+            self.collection.update_properties("foo", title="Bar")
+            self.assertEqual("Bar", self.collection["foo"]["title"])
+        self.assertEqual("Bar", self.collection["foo"]["title"])
+
+    def test_get(self):
+        self.assertIsNone(self.collection.get("foo"))
+        self.collection.add_html("foo", "", type="content")
+        self.assertEqual("content", self.collection.get("foo")["type"])
+        with self.collection.batch():
+            self.collection.add_html("bar", "", type="redirect")
+            self.assertEqual("redirect", self.collection.get("bar")["type"])
+
+    def test_unparsed_index(self):
+        self.assertIsNone(self.collection.unparsed_keys(1))
+        self.collection.mark_parsed({}, full_pass_hash=1)
+        self.assertEqual({}, self.collection.unparsed_keys(1))
+        with self.collection.batch():
+            self.collection.add_html("foo", "", type="content", parsed_hash="")
+            self.collection.mark_unparsed("foo")
+            self.assertEqual(["foo"], list(self.collection.unparsed_keys(1)))
+        self.assertIsNone(self.collection.unparsed_keys(2))
+        self.collection.mark_parsed(self.collection.unparsed_keys(1))
+        self.assertEqual({}, self.collection.unparsed_keys(1))
+        self.assertEqual(1, len(self.collection))
+
+        # a full pass settles the keys in the index before it, including those it had nothing to parse for
+        self.collection.mark_unparsed("bar")
+        marks = self.collection.unparsed_marks()
+        self.collection.mark_parsed(marks, full_pass_hash=2)
+        self.assertEqual({}, self.collection.unparsed_keys(2))
+
+    def test_keys_marked_during_a_pass_stay_marked(self):
+        self.collection.mark_parsed({}, full_pass_hash=1)
+        self.collection.mark_unparsed("foo")
+        self.collection.mark_unparsed("bar")
+        marks = self.collection.unparsed_keys(1)
+        # the crawler stores a new version of foo, and a new document, while the pass runs
+        self.collection.mark_unparsed("foo")
+        self.collection.mark_unparsed("baz")
+        self.collection.mark_parsed(marks)
+        self.assertEqual(["baz", "foo"], sorted(self.collection.unparsed_keys(1)))
+
+        marks = self.collection.unparsed_marks()
+        self.collection.mark_unparsed("baz")
+        self.collection.mark_parsed(marks, full_pass_hash=2)
+        self.assertEqual(["baz"], list(self.collection.unparsed_keys(2)))
@@ -0,0 +1,56 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+from lmdb_collection import LmdbmDocumentCollection
+
+
+def add_documents(file: str, start: int, count: int) -> None:
+    # 64 KiB documents, so that a handful of them outgrow a 1 MiB map and make it autogrow
+    collection = LmdbmDocumentCollection(file, map_size=2 ** 20)
+    with collection.batch():
+        for i in range(start, start + count):
+            collection.add_html(str(i), "x" * 65536, type="content", parsed_hash="", crawled=0)
+    collection.close()
+
+
+class TestBrowse(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.data_dir = tempfile.mkdtemp()
+        os.chdir(self.data_dir)
+        os.makedirs("data")
+
+    def tearDown(self):
+        main.close_collections()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.data_dir)
+
+    def browse(self):
+        return asyncio.run(main.browse_results("testing", page=0, rows=10, fullcontent=False))
+
+    def test_browse_after_another_process_grows_the_map(self):
+        add_documents("data/testing.crawl", 0, 1)
+        # the long-lived reader: a collection that stays open between requests, with a map smaller than the crawl's
+        main.open_collections["testing"] = LmdbmDocumentCollection("data/testing.crawl", map_size=2 ** 20)
+        self.assertEqual(1, self.browse()["num_records"])
+
+        crawl = multiprocessing.get_context("spawn").Process(target=add_documents,
+                                                             args=("data/testing.crawl", 1, 64))
+        crawl.start()
+        crawl.join()
+        self.assertEqual(0, crawl.exitcode)
+
+        context = self.browse()
+        self.assertEqual(65, context["num_records"])
+        self.assertEqual(10, len(context["items"]))
+        self.assertIs(main.open_collections["testing"], main.get_collection("testing"))
+
+
+if __name__ == '__main__':
+    unittest.main()
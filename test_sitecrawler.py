@@ -1,15 +1,24 @@
 import json
+import re
+import shutil
+import tempfile
 import time
 import unittest
+from collections import Counter
+from unittest import mock
 
-from sitecrawler import SiteCrawler, ExtractionRules, do_extract
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from sitecrawler import SiteCrawler, ExtractionRules, do_extract, do_extraction, get_type_from_url
 
 
 class TestSiteCrawler(unittest.TestCase):
 
     def test_valid_link_domains(self):
         crawler = SiteCrawler("testing", starting_urls=["https://www.example.com"], allow_starting_url_tld=True,
-                              allow_starting_url_hostname=True)
+                              allow_starting_url_hostname=True, init_collection=False)
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com"))
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/index.html"))
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/foo/index.html"))
@@ -21,7 +30,7 @@ class TestSiteCrawler(unittest.TestCase):
 
         crawler = SiteCrawler("testing", starting_urls=["https://www.example.com"],
                               allow_starting_url_tld=False,
-                              allow_starting_url_hostname=True)
+                              allow_starting_url_hostname=True, init_collection=False)
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/index.html"))
         self.assertFalse(crawler.valid_link("https://www.example.com", "https://example.com/index.html"))
         self.assertFalse(crawler.valid_link("https://www.example.com", "https://foo.example.com/index.html"))
@@ -29,7 +38,7 @@ class TestSiteCrawler(unittest.TestCase):
 
         crawler = SiteCrawler("testing", starting_urls=["https://www.example.com"],
                               allow_starting_url_tld=True,
-                              allow_starting_url_hostname=False)
+                              allow_starting_url_hostname=False, init_collection=False)
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/index.html"))
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://example.com/index.html"))
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://foo.example.com/index.html"))
@@ -38,23 +47,73 @@ class TestSiteCrawler(unittest.TestCase):
         crawler = SiteCrawler("testing", starting_urls=["https://www.example.com"],
                               allowed_domains=["foo.example.com"],
                               allow_starting_url_tld=False,
-                              allow_starting_url_hostname=False)
+                              allow_starting_url_hostname=False, init_collection=False)
         self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/index.html"))
         self.assertFalse(crawler.valid_link("https://www.example.com", "https://example.com/index.html"))
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://foo.example.com/index.html"))
         self.assertFalse(crawler.valid_link("https://www.example.com", "https://google.com/index.html"))
 
+        crawler = SiteCrawler("testing", starting_urls=["https://foo.github.io"], allow_starting_url_tld=True,
+                              init_collection=False)
+        self.assertTrue(crawler.valid_link("https://foo.github.io", "https://www.foo.github.io/index.html"))
+        self.assertFalse(crawler.valid_link("https://foo.github.io", "https://bar.github.io/index.html"))
+
+        crawler = SiteCrawler("testing", starting_urls=["https://www.bbc.co.uk"], allow_starting_url_tld=True,
+                              init_collection=False)
+        self.assertTrue(crawler.valid_link("https://www.bbc.co.uk", "https://news.bbc.co.uk/index.html"))
+        self.assertFalse(crawler.valid_link("https://www.bbc.co.uk", "https://www.example.co.uk/index.html"))
+
     def test_valid_link_includes_excludes(self):
         crawler = SiteCrawler("testing", starting_urls=["https://www.example.com"],
                               allowed_regex=[".html$"],
                               denied_regex=[".css$"],
-                              )
+                              init_collection=False)
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/index.html"))
         self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/index.css"))
 
         # any link that is not explicitly excluded is allowed as long as it matches domain rules
         self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/index.htmlsss"))
 
+        crawler = SiteCrawler("testing", starting_urls=["https://www.example.com"],
+                              allowed_regex=[r"\.pdf$", "/docs/.+"], denied_regex=["/files/"],
+                              denied_extensions=".pdf,.zip", init_collection=False)
+        self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/files/a.PDF"))
+        self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/docs/a.zip"))
+        self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/files/apdf"))
+        self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/a.zip"))
+
+    def test_valid_link_denied_regex(self):
+        crawler = SiteCrawler("testing", starting_urls=["https://www.example.com"],
+                              denied_regex=["/Location", "/tag/"], denied_extensions=".pdf,.zip",
+                              init_collection=False)
+        self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/location/1"))
+        self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/blog/tag/news"))
+        self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/logo.PNG"))
+        self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/files/a.zip"))
+        self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/blog/news"))
+        self.assertFalse(crawler.valid_link("https://www.example.com", "ftp://www.example.com/files/a.txt"))
+        self.assertFalse(crawler.valid_link("https://www.example.com", "https://www.example.com/app.js?v=2"))
+        self.assertTrue(crawler.valid_link("https://www.example.com", "https://www.example.com/index.jsp"))
+        self.assertFalse(crawler.valid_link("https://www.example.com", "https://user@www.example.com/"))
+
+    def test_extract_links(self):
+        crawler = SiteCrawler("testing", starting_urls=["https://www.example.com"], init_collection=False)
+        html = '''<html><body>
+            <a href="https://www.example.com/about#team">About</a>
+            <a href="/careers">Careers</a>
+            <a href="//www.example.com/blog/">Blog</a>
+            <a href="../contact.html">Contact</a>
+            <a href="mailto:info@example.com">Mail</a>
+            <a href="#top">Top</a>
+            <a href="javascript:void(0)">Menu</a>
+            <a href="tel:+15555555555">Call</a>
+            <a href="https://google.com/">Google</a>
+            <a>No href</a>
+        </body></html>'''
+        links = crawler.extract_links("https://www.example.com/docs/index.html", html)
+        self.assertEqual({"https://www.example.com/about", "https://www.example.com/careers",
+                          "https://www.example.com/blog/", "https://www.example.com/contact.html"}, set(links))
+
     def test_extract_css(self):
         content = "<html><title>foo</title></html>"
         rules = ExtractionRules.model_validate_json(
@@ -77,6 +136,15 @@ class TestSiteCrawler(unittest.TestCase):
             json.dumps({"rules": [{"field_name": "title", "regex": "<animals>(.*?)</animals>"}]}))
         self.assertEqual("", do_extract(content, rules)["title"])
 
+        with self.assertRaises(re.error):
+            ExtractionRules.model_validate_json(json.dumps({"rules": [{"field_name": "title", "regex": "<animal>(.*?"}]}))
+
+    def test_get_type_from_url(self):
+        self.assertEqual("Web Page", get_type_from_url("https://www.example.com/"))
+        self.assertEqual("Blog", get_type_from_url("https://www.example.com/blog/post-1"))
+        self.assertEqual("Case Studies", get_type_from_url("https://www.example.com/case-studies/"))
+        self.assertEqual("My Docs", get_type_from_url("https://www.example.com/my_docs/a.pdf"))
+
     def test_cache_expiry(self):
         crawler = SiteCrawler("testing", [], cache_ttl_hours=-1, init_collection=False)
         crawler.collection = {"foo": {"type": "content"}}
@@ -87,5 +155,204 @@ class TestSiteCrawler(unittest.TestCase):
         self.assertFalse(crawler.is_cached_url("foo"))
 
 
+class TestOutput(unittest.TestCase):
+    url = "https://www.example.com/a"
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.crawler = SiteCrawler("testing", ["https://www.example.com"], cache_ttl_hours=0.5,
+                                   data_dir=self.data_dir)
+        self.collection = self.crawler.collection
+        self.collection.mark_parsed({}, full_pass_hash=1)
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.data_dir)
+
+    def output(self, content, last_modified=None):
+        headers = CIMultiDict()
+        if last_modified is not None:
+            headers["Last-Modified"] = last_modified
+        self.crawler.output("text/html", self.url, [], content, CIMultiDictProxy(headers))
+
+    def store_parsed(self, content, crawled, **properties):
+        # a document as a previous crawl and extraction left it
+        self.collection.add_html(self.url, content, type="content", parsed_hash="abc", crawled=crawled,
+                                 server_last_modified=None, title="A", **properties)
+        self.collection.mark_parsed(self.collection.unparsed_marks())
+
+    def test_new_body(self):
+        self.output("<html>a</html>", last_modified="Mon, 01 Jan 2024 00:00:00 GMT")
+        entry = self.collection[self.url]
+        self.assertEqual("<html>a</html>", entry["_content"])
+        self.assertEqual("", entry["parsed_hash"])
+        self.assertEqual("Mon, 01 Jan 2024 00:00:00 GMT", entry["server_last_modified"])
+        self.assertIn("body_hash", entry)
+        self.assertEqual([self.url], list(self.collection.unparsed_keys(1)))
+        self.assertEqual(1, self.crawler.stats["new_or_updated"])
+
+    def test_unchanged_body(self):
+        self.output("<html>a</html>")
+        crawled = time.time() - 60
+        self.store_parsed("<html>a</html>", crawled, body_hash=self.collection[self.url]["body_hash"])
+        self.output("<html>a</html>")
+        entry = self.collection[self.url]
+        self.assertEqual(("abc", "A", crawled), (entry["parsed_hash"], entry["title"], entry["crawled"]))
+        self.assertEqual([], list(self.collection.unparsed_keys(1)))
+        self.assertEqual(0, self.crawler.stats["unchanged"])
+
+    def test_changed_body(self):
+        self.output("<html>a</html>")
+        self.store_parsed("<html>a</html>", time.time() - 3600, body_hash=self.collection[self.url]["body_hash"])
+        self.output("<html>b</html>")
+        entry = self.collection[self.url]
+        self.assertEqual(("<html>b</html>", ""), (entry["_content"], entry["parsed_hash"]))
+        self.assertNotIn("title", entry)
+        self.assertEqual([self.url], list(self.collection.unparsed_keys(1)))
+        self.assertEqual(2, self.crawler.stats["new_or_updated"])
+
+    def test_expired_unchanged_body(self):
+        self.output("<html>a</html>")
+        self.store_parsed("<html>a</html>", time.time() - 3600, body_hash=self.collection[self.url]["body_hash"])
+        self.output("<html>a</html>", last_modified="Mon, 01 Jan 2024 00:00:00 GMT")
+        entry = self.collection[self.url]
+        self.assertEqual(("abc", "A"), (entry["parsed_hash"], entry["title"]))
+        self.assertGreaterEqual(entry["crawled"], self.crawler.start_time)
+        self.assertEqual("Mon, 01 Jan 2024 00:00:00 GMT", entry["server_last_modified"])
+        self.assertEqual([], list(self.collection.unparsed_keys(1)))
+        self.assertEqual(1, self.crawler.stats["unchanged"])
+
+    def test_legacy_entry_without_body_hash(self):
+        self.store_parsed("<html>a</html>", time.time() - 3600)
+        self.output("<html>a</html>")
+        entry = self.collection[self.url]
+        self.assertEqual("", entry["parsed_hash"])
+        self.assertIn("body_hash", entry)
+        self.assertEqual([self.url], list(self.collection.unparsed_keys(1)))
+        self.assertEqual(1, self.crawler.stats["new_or_updated"])
+
+
+class TestDoExtraction(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.crawler = SiteCrawler("testing", ["https://www.example.com"], data_dir=self.data_dir,
+                                   extraction_rules={"rules": [{"field_name": "title", "css": "title"}]})
+        self.collection = self.crawler.collection
+        self.parsed_hash = self.crawler.extraction_rules.compute_hash()
+
+    def tearDown(self):
+        self.collection.close()
+        shutil.rmtree(self.data_dir)
+
+    def add(self, url, title):
+        self.collection.add_html(url, f"<html><title>{title}</title></html>", type="content", parsed_hash="",
+                                 crawled=time.time())
+        self.collection.mark_unparsed(url)
+
+    def titles(self):
+        return {k: v.get("title") for k, v in self.collection.filter_items("type", "content")}
+
+    def test_full_then_incremental_passes(self):
+        a, b, c = "https://www.example.com/a", "https://www.example.com/b", "https://www.example.com/c"
+        self.add(a, "A")
+        self.add(b, "B")
+        self.assertIsNone(self.collection.unparsed_keys(self.parsed_hash))
+
+        do_extraction(self.crawler, processes=1)
+        self.assertEqual({a: "A", b: "B"}, self.titles())
+        self.assertEqual([], list(self.collection.unparsed_keys(self.parsed_hash)))
+
+        self.add(a, "A2")
+        self.add(c, "C")
+        # marked for parsing, then replaced by an error, so there is nothing left to parse
+        self.collection.mark_unparsed(b)
+        self.crawler.log_error_url(b, 404, "Not found")
+        self.assertEqual(sorted([a, b, c]), sorted(self.collection.unparsed_keys(self.parsed_hash)))
+
+        for i in range(2):
+            do_extraction(self.crawler, processes=1)
+            self.assertEqual({a: "A2", c: "C"}, self.titles())
+            self.assertEqual([], list(self.collection.unparsed_keys(self.parsed_hash)))
+            self.assertEqual(self.parsed_hash, self.collection[a]["parsed_hash"])
+
+    def test_incremental_pass_starts_no_more_processes_than_chunks(self):
+        self.collection.mark_parsed({}, full_pass_hash=self.parsed_hash)
+        self.add("https://www.example.com/a", "A")
+        with mock.patch("os.cpu_count", return_value=8), \
+                mock.patch("sitecrawler.ProcessPoolExecutor") as pool:
+            do_extraction(self.crawler)
+        pool.assert_not_called()
+        self.assertEqual({"https://www.example.com/a": "A"}, self.titles())
+
+
+class TestSiteCrawlerCrawl(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.hits = Counter()
+        app = web.Application()
+        app.router.add_get("/", self.page('<a href="/page">Page</a><a href="/redir">Redirect</a>'
+                                          '<a href="/file.zip">Zip</a><a href="/zip">Zip redirect</a>'))
+        app.router.add_get("/page", self.page("<title>Page</title>"))
+        app.router.add_get("/redir", self.redirect("/page"))
+        app.router.add_get("/file.zip", self.zip)
+        app.router.add_get("/zip", self.redirect("/file.zip"))
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        shutil.rmtree(self.data_dir)
+
+    def page(self, html):
+        async def handler(request):
+            self.hits[request.path] += 1
+            return web.Response(text=f"<html><body>{html}</body></html>", content_type="text/html")
+        return handler
+
+    async def zip(self, request):
+        self.hits[request.path] += 1
+        return web.Response(body=b"PK", content_type="application/zip")
+
+    def redirect(self, location):
+        async def handler(request):
+            self.hits[request.path] += 1
+            raise web.HTTPFound(location)
+        return handler
+
+    def url(self, path):
+        return str(self.server.make_url(path))
+
+    async def crawl(self):
+        crawler = SiteCrawler("testing", [self.url("/")], concurrency=1, data_dir=self.data_dir)
+        await crawler.get_results()
+        return crawler
+
+    async def test_redirect_to_crawled_page_is_cached(self):
+        crawler = await self.crawl()
+        try:
+            self.assertEqual({"type": "redirect", "redirected_url": self.url("/page")},
+                             crawler.collection[self.url("/redir")])
+        finally:
+            crawler.collection.close()
+
+        crawler = await self.crawl()
+        crawler.collection.close()
+        self.assertEqual(1, self.hits["/redir"])
+        self.assertEqual(1, crawler.stats["cached_redirects"])
+
+    async def test_redirect_to_page_never_stored_is_fetched_again(self):
+        for i in range(2):
+            crawler = await self.crawl()
+            try:
+                self.assertEqual({"type": "redirect", "redirected_url": self.url("/file.zip")},
+                                 crawler.collection[self.url("/zip")])
+                self.assertEqual(0, crawler.stats["exception"])
+            finally:
+                crawler.collection.close()
+        self.assertEqual(2, self.hits["/zip"])
+
+
 if __name__ == '__main__':
     unittest.main()